@@ -18,7 +18,9 @@ class OpenvSwitch:
         """
         self.install_debs(-100, "openvswitch-switch.tgz")
 
-    def bridge_layer2(self, time, bridge_name="br0", interfaces=None):
+    def bridge_layer2(
+        self, time, bridge_name="br0", interfaces=None, ovs_commands=None
+    ):
         """
         Create layer 2 connections by putting all the specified interfaces
         on a newly created bridge with the specified name.
@@ -29,11 +31,15 @@ class OpenvSwitch:
             interfaces (list): List of MAC addresses corresponding to the interfaces
                 to be added to the layer 2 bridge. Uses MAC addresses because
                 interface names aren't guaranteed to be consistent.
+            ovs_commands (list): Additional ``ovs-vsctl`` commands (e.g. to
+                create mirrors) to run in a single invocation once the bridge
+                has been created.
         """
-        if not interfaces:
-            interfaces = []
-        argument = bridge_name
-        for interface in interfaces:
-            argument += f" {interface.lower()}"
+        arguments = [bridge_name]
+        if interfaces:
+            arguments.extend(interface.lower() for interface in interfaces)
+        if ovs_commands:
+            arguments.extend(("--", " -- ".join(ovs_commands)))
+        argument = " ".join(arguments)
 
         self.run_executable(time, "bridge_layer2.sh", argument, vm_resource=True)
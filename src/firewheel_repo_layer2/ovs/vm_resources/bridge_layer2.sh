@@ -8,12 +8,20 @@ ip link set dev $BRIDGE up
 # Shift off the first arg since it's the bridge name
 shift
 
-# All the other args are the passed in MAC addresses
-for mac in "$@";
+# All the other args up to an optional "--" are the passed in MAC addresses
+while [[ $# -gt 0 && $1 != "--" ]];
 do
+    mac=$1
     interface=$(ip -o link | grep ${mac} | awk '{print $2}' | sed 's/://')
     if [[ ! -z $interface ]]; then
         ovs-vsctl --may-exist add-port $BRIDGE $interface
         ip link set dev $interface up
     fi
+    shift
 done
+
+# Any args after the "--" are additional ovs-vsctl commands
+if [[ $# -gt 1 ]]; then
+    shift
+    ovs-vsctl "$@"
+fi
@@ -1,19 +1,39 @@
 # No need for secure random
-from random import randint  # noqa: DUO102
+from random import getrandbits  # noqa: DUO102
 
-from netaddr import EUI, mac_unix_expanded
 from layer2.ovs import OpenvSwitch
 
 from firewheel.control.experiment_graph import require_class
 
+# IEEE 802 flags in the first octet of a MAC address
+_MAC_MULTICAST_BIT = 0x01
+_MAC_LOCAL_BIT = 0x02
+
 
 @require_class(OpenvSwitch)
 class Tap:
     """Create a tap object.
     This is essentially an :py:class:`OpenvSwitch <layer2.ovs.OpenvSwitch>` object
     with additional functions to man-in-the-middle and/or mirror traffic.
+
+    The bridging and mirroring set up by :py:meth:`l2_mitm` and
+    :py:meth:`mirror_traffic` is queued on the tap and scheduled by
+    :py:meth:`emit_boot_script`. When a single bridge is pending, the bridge and
+    all of the mirrors are created by one VM resource.
+
+    Warning:
+        :py:meth:`l2_mitm` and :py:meth:`mirror_traffic` do not schedule
+        anything on the VM by themselves. Any model component which calls them
+        must call :py:meth:`emit_boot_script` afterwards.
     """
 
+    def __init__(self):
+        """
+        Initialize the pending layer 2 bridges and ``ovs-vsctl`` commands.
+        """
+        self._tap_bridges = []
+        self._tap_boot_script = []
+
     def l2_mitm(self, bridge_name="br0"):
         """
         Create a layer 2 bridge that "breaks" the link, thus
@@ -25,26 +45,41 @@ class Tap:
             of layer 3 configuration is assumed to mean that the interface
             is only a layer 2 interface.
 
+        Note:
+            The bridge is only created once :py:meth:`emit_boot_script`
+            is called.
+
         Args:
             bridge_name (str): Name of the bridge to be created on the
                 VM. All layer 2 interfaces then get dropped on the bridge
         """
-        interfaces = []
-        for interface in self.interfaces.interfaces:
-            if "address" not in interface or not interface["address"]:
-                if "mac" not in interface or not interface["mac"]:
-                    # The top bit in MAC addresses is the multicast bit, therefore
-                    # it must not be set. The second bit is the local bit. Easiest
-                    # to just clear the top octet
-                    # There are no security concerns with using random here.
-                    mac = EUI(
-                        randint(1000, 281474976710655) & 0x00FFFFFFFFFF,  # nosec B311
-                        dialect=mac_unix_expanded,
-                    )
-                    interface["mac"] = str(mac)
-                interfaces.append(interface["mac"].lower())
-
-        self.bridge_layer2(-90, bridge_name=bridge_name, interfaces=interfaces)
+        l2_interfaces = [
+            interface
+            for interface in self.interfaces.interfaces
+            if not interface.get("address")
+        ]
+        missing_macs = [
+            interface for interface in l2_interfaces if not interface.get("mac")
+        ]
+
+        # Draw the random MAC addresses for all of the layer 2 interfaces
+        # that need one at once, rather than one interface at a time.
+        # Python 3.8 does not allow drawing zero bits, so skip the draw
+        # when every interface already has a MAC.
+        # There are no security concerns with using random here.
+        if missing_macs:
+            octets = getrandbits(48 * len(missing_macs)).to_bytes(  # nosec B311
+                6 * len(missing_macs), "big"
+            )
+            for index, interface in enumerate(missing_macs):
+                mac = bytearray(octets[6 * index : 6 * (index + 1)])
+                # Generated MACs must be unicast and locally administered
+                mac[0] = (mac[0] & ~_MAC_MULTICAST_BIT) | _MAC_LOCAL_BIT
+                interface["mac"] = mac.hex(":")
+
+        # The MACs are lowercased by `bridge_layer2`
+        interfaces = [interface["mac"] for interface in l2_interfaces]
+        self._tap_bridges.append((bridge_name, interfaces))
 
     def mirror_traffic(self, bridge, *tunnel_params):
         """
@@ -53,6 +88,10 @@ class Tap:
         tunnel with the specified key. It is expected that the VM hosting the
         specified IP has a GRE endpoint configured.
 
+        Note:
+            The mirrors are only created once :py:meth:`emit_boot_script`
+            is called.
+
         Args:
             bridge (str): Name of the bridge holding the interfaces that will
                 have their traffic mirrored.
@@ -67,19 +106,61 @@ class Tap:
         if not tunnel_params:
             raise ValueError("Tunnel parameters need to be provided to mirror traffic.")
 
-        arguments = ""
+        commands = self._tap_boot_script
         mirror_ids = []
         for ip, key in tunnel_params:
             mirror_id = f"@m{key}"
             mirror_ids.append(mirror_id)
-            arguments += (
+            commands.append(
                 f"add-port {bridge} "
                 f"gre{key} -- "
                 f"set interface gre{key} type=gre options:remote_ip={ip} options:key={key} -- "
                 f"--id=@p{key} get port gre{key} -- "
-                f"--id={mirror_id} create mirror name=mirror{key} select-all=true output-port=@p{key} -- "
+                f"--id={mirror_id} create mirror name=mirror{key} select-all=true output-port=@p{key}"
             )
 
         # Add all mirror IDs to the bridge
-        arguments += f"set bridge {bridge} mirrors={','.join(mirror_ids)}"
-        self.run_executable(-75, "ovs-vsctl", arguments)
+        commands.append(f"set bridge {bridge} mirrors={','.join(mirror_ids)}")
+
+    def emit_boot_script(self, time=-90, mirror_time=-75):
+        """
+        Schedule the layer 2 bridges from :py:meth:`l2_mitm` and the
+        ``ovs-vsctl`` commands from :py:meth:`mirror_traffic`.
+
+        If exactly one bridge is pending, a single VM resource creates the
+        bridge and then runs all of the ``ovs-vsctl`` commands in one
+        invocation. Otherwise, each pending bridge is created at ``time`` and
+        all of the ``ovs-vsctl`` commands are run in one invocation at
+        ``mirror_time`` (e.g. for mirrors on a bridge created directly with
+        :py:meth:`bridge_layer2 <layer2.ovs.OpenvSwitch.bridge_layer2>`).
+
+        This must be called by any model component that uses :py:meth:`l2_mitm`
+        or :py:meth:`mirror_traffic`, once it has finished setting up the tap
+        (e.g. the ``layer2.tap`` plugin calls it once per tap VM).
+        Once scheduled, the pending bridges and ``ovs-vsctl`` commands are
+        cleared so that they are not scheduled again by a later call.
+
+        Args:
+            time (int): Schedule time to create the layer 2 bridges on the VM.
+            mirror_time (int): Schedule time to run the ``ovs-vsctl`` commands
+                when they cannot be combined with a single pending bridge.
+        """
+        bridges = self._tap_bridges
+        commands = self._tap_boot_script
+        self._tap_bridges = []
+        self._tap_boot_script = []
+
+        if len(bridges) == 1:
+            bridge_name, interfaces = bridges[0]
+            self.bridge_layer2(
+                time,
+                bridge_name=bridge_name,
+                interfaces=interfaces,
+                ovs_commands=commands,
+            )
+            return
+
+        for bridge_name, interfaces in bridges:
+            self.bridge_layer2(time, bridge_name=bridge_name, interfaces=interfaces)
+        if commands:
+            self.run_executable(mirror_time, "ovs-vsctl", " -- ".join(commands))
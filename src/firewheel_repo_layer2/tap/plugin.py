@@ -1,9 +1,16 @@
-from netaddr import IPNetwork
+from itertools import count
+
+from netaddr import IPAddress, IPNetwork
 from layer2.tap import Tap
 from base_objects import Switch, FalseEdge, VMEndpoint
 
 from firewheel.control.experiment_graph import Vertex, AbstractPlugin
 
+# Each tap and its collectors share a /24 pulled out of the collector network
+_SUBNET_PREFIXLEN = 24
+_SUBNET_SIZE = 2 ** (32 - _SUBNET_PREFIXLEN)
+_SUBNET_NETMASK = IPAddress((2**32 - 1) ^ (_SUBNET_SIZE - 1))
+
 
 class InsertTaps(AbstractPlugin):
     """
@@ -11,9 +18,10 @@ class InsertTaps(AbstractPlugin):
     all mirrored traffic to the "collector" (i.e. Splunk, Bro, etc)
     specified on the :py:class:`Edge <firewheel.control.experiment_graph.Edge>`.
 
-    Each "collector" gets an additional IP network in order to have
-    the mirrored traffic from the taps GRE tunneled to it. Each
-    tunnel gets its own interface of the form ``tap<integer>`` where
+    Each set of "collectors" gets an additional IP network in order to have
+    the mirrored traffic from the taps GRE tunneled to it. This network is
+    shared by all of the taps mirroring traffic to that set of collectors.
+    Each tunnel gets its own interface of the form ``tap<integer>`` where
     integer is the GRE key. For example, if there is a tunnel between
     the "collector" and a tap using a GRE key of 1000 then the "collector"
     will have an interface named ``tap1000``. The ``tapX`` interfaces should then
@@ -36,20 +44,255 @@ class InsertTaps(AbstractPlugin):
                 :py:class:`Edge <firewheel.control.experiment_graph.Edge>` is not a name of the
                 collector :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` nor the
                 actual :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` object.
+            RuntimeError: If ``collector_network`` does not contain enough /24
+                subnets for all of the tapped edges, or if there are too many
+                collectors on an edge to fit in a /24 subnet.
         """
+        # Get all original edges with collectors (before modifying any edges).
+        # Collectors will be saved as the `tap` attribute of the edge
+        tapped_edges = [
+            edge for edge in self.g.get_edges() if getattr(edge, "tap", None)
+        ]
+        if not tapped_edges:
+            return
+
+        # GRE tunnel endpoints for each collector, set up once all edges are tapped
+        self._gre_endpoints = {}
+        # Interfaces of each tapped endpoint, indexed by IP address
+        self._interface_index = {}
+        # Collector vertices which have been looked up by name
+        self._vertex_by_name = {}
+        # Each GRE tunnel gets a unique key, starting at 1000
+        gre_keys = count(1000)
+
         collector_networks = IPNetwork(collector_network)
-        # Pull /24 subnets out of the larger network
-        subnets = collector_networks.subnet(24)
+        # Pull /24 subnets out of the larger network. Subnets are tracked as
+        # integers rather than `IPNetwork` objects to avoid the netaddr overhead
+        subnets_base = int(collector_networks.network)
+        num_subnets = 0
+        if collector_networks.prefixlen <= _SUBNET_PREFIXLEN:
+            num_subnets = 2 ** (_SUBNET_PREFIXLEN - collector_networks.prefixlen)
+
+        # Group the edges by their collectors, so that each set of collectors
+        # only needs a single subnet and switch for all of its taps
+        collector_groups = {}
+        for edge in tapped_edges:
+            # Ensure that the collectors are a list of `Vertex` objects / VM endpoints
+            collectors = edge.tap
+            if not isinstance(collectors, (list, tuple)):
+                collectors = [collectors]
+            collectors = list(
+                dict.fromkeys(self._validate_collector(_) for _ in collectors)
+            )
+            group = collector_groups.setdefault(frozenset(collectors), (collectors, []))
+            group[1].append(edge)
+
+        # Each tap also needs an IP address on the collector network, so a
+        # large group may need to be split across several subnets
+        subnet_groups = []
+        for collectors, edges in collector_groups.values():
+            taps_per_subnet = _SUBNET_SIZE - 2 - len(collectors)
+            if taps_per_subnet < 1:
+                raise RuntimeError(
+                    "A /24 subnet does not have enough IP addresses for "
+                    f"{len(collectors)} collectors and their taps."
+                )
+            subnet_groups.extend(
+                (collectors, edges[start : start + taps_per_subnet])
+                for start in range(0, len(edges), taps_per_subnet)
+            )
+
+        # Ensure there are enough subnets before modifying the graph
+        if len(subnet_groups) > num_subnets:
+            raise RuntimeError(
+                f"The collector network {collector_network} does not have "
+                "enough /24 subnets for all of the tapped edges "
+                f"({len(subnet_groups)} are needed)."
+            )
+        subnets = [
+            subnets_base + index * _SUBNET_SIZE for index in range(len(subnet_groups))
+        ]
 
-        def _has_collectors(edge):
-            # Collectors will be saved as the `tap` attribute of the edge
-            return bool(getattr(edge, "tap", False))
+        for subnet, (collectors, edges) in zip(subnets, subnet_groups):
+            monitor_network = _CollectorNetwork(self, subnet, collectors)
+            for edge in edges:
+                _EdgeTapper(self, edge, monitor_network, gre_keys).tap_edge()
 
-        # Get all original edges with collectors (before modifying any edges)
-        for edge in list(filter(_has_collectors, self.g.get_edges())):
-            network = next(subnets)
-            collectors = edge.tap
-            _EdgeTapper(edge, network).tap_edge(collectors)
+        self._set_up_gre_tunnel_endpoints()
+
+    def _validate_collector(self, collector):
+        """
+        Ensure that a given collector is a VM endpoint (or look it up).
+
+        Args:
+            collector (Vertex): A collector to be validated (or, if the
+                collector is provided as a name, find the corresponding
+                :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>`.
+
+        Returns:
+            Vertex: The validated collector vertex.
+
+        Raises:
+            RuntimeError: If the collector specified is not a name of the
+                collector :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` nor the
+                actual :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` object.
+        """
+        if isinstance(collector, str):
+            collector = self._lookup_vertex(collector)
+        if collector is None or not collector.is_decorated_by(VMEndpoint):
+            raise RuntimeError(
+                "The collector specified on an `Edge` must be either the "
+                "name of the collector vertex or the `Vertex` object."
+            )
+        return collector
+
+    def _lookup_vertex(self, name):
+        """
+        Find the :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>`
+        with the given name.
+
+        Collectors are commonly shared by many tapped edges, so the result of
+        each lookup is cached to avoid searching the graph repeatedly.
+
+        Args:
+            name (str): The name of the vertex.
+
+        Returns:
+            Vertex: The vertex with the given name or :py:data:`None` if no
+            such vertex exists.
+        """
+        vertex = self._vertex_by_name.get(name)
+        if vertex is None:
+            vertex = self.g.find_vertex(name)
+            self._vertex_by_name[name] = vertex
+        return vertex
+
+    def _find_interface(self, endpoint, address):
+        """
+        Find the interface on an endpoint that has the given IP address.
+
+        The interfaces of each endpoint are indexed by IP address the first
+        time the endpoint is searched, which avoids scanning all of the
+        interfaces for every tapped edge. The index is rebuilt if the
+        address is not found, in case the interfaces have since changed.
+
+        Args:
+            endpoint (Vertex): The VM endpoint to search.
+            address (netaddr.IPAddress): The IP address of the interface.
+
+        Returns:
+            dict: The matching interface or :py:data:`None` if no interface
+            on the endpoint has the given IP address.
+        """
+        index = self._interface_index.get(endpoint)
+        if index is None or address not in index:
+            index = {}
+            for interface in endpoint.interfaces.interfaces:
+                index.setdefault(interface.get("address"), interface)
+            self._interface_index[endpoint] = index
+        return index.get(address)
+
+    def _replace_interface(self, endpoint, address, interface):
+        """
+        Replace the indexed interface on an endpoint with the given IP address.
+
+        This keeps the index used by :py:meth:`_find_interface` consistent
+        once the interface with ``address`` has been re-created.
+
+        Args:
+            endpoint (Vertex): The VM endpoint with the new interface.
+            address (netaddr.IPAddress): The IP address of the interface.
+            interface (dict): The new interface.
+        """
+        self._interface_index.setdefault(endpoint, {})[address] = interface
+
+    def _add_gre_endpoint(self, collector, key, local_ip, remote_ip):
+        """
+        Record a GRE tunnel endpoint to set up on a collector.
+
+        The endpoints are created by :py:meth:`_set_up_gre_tunnel_endpoints`
+        once all of the edges have been tapped.
+
+        Args:
+            collector (Vertex): The collector on which to add the endpoint.
+            key (int): The GRE key of the tunnel.
+            local_ip (netaddr.IPAddress): The IP of the collector in the
+                collector subnet.
+            remote_ip (netaddr.IPAddress): The IP of the tap VM in the
+                collector subnet.
+        """
+        self._gre_endpoints.setdefault(collector, []).append(
+            f"{key} {local_ip} {remote_ip}"
+        )
+
+    def _set_up_gre_tunnel_endpoints(self):
+        """
+        Add all of the GRE tunnel endpoints on each collector.
+
+        Every tunnel terminating on a collector is created by a single
+        ``gre_tunnel_endpoints.sh`` VM resource, rather than scheduling
+        separate ``ip link`` commands for each tunnel.
+        """
+        for collector, endpoints in self._gre_endpoints.items():
+            collector.run_executable(
+                -100, "gre_tunnel_endpoints.sh", " ".join(endpoints), vm_resource=True
+            )
+
+
+class _CollectorNetwork:
+    """
+    A transient object used to connect a set of collectors to a /24
+    network, which is shared by all of the taps mirroring traffic to
+    those collectors.
+    """
+
+    __slots__ = ("_next_host", "collector_ips", "network", "switch")
+
+    def __init__(self, plugin, network, collectors):
+        """Initialize the Object.
+
+        Arguments:
+            plugin (InsertTaps): The plugin tapping the edges.
+            network (int): The first address of the /24 network used by the
+                collectors and their taps.
+            collectors (list): A list of validated collector
+                :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` objects.
+
+        Attributes:
+            network (int): The first address of the /24 network used by the
+                collectors and their taps.
+            switch (Vertex): The switch connecting the taps to the collectors.
+            collector_ips (list): A list of ``(collector, ip)`` tuples with
+                each collector vertex and its IP address in ``network``.
+            _next_host (int): The last host address assigned in ``network``.
+        """
+        self.network = network
+        self._next_host = network
+        self.switch = Vertex(plugin.g, f"tap-collectors-{IPAddress(network)}.switch")
+        self.switch.decorate(Switch)
+        # Connect each collector into the collector network
+        self.collector_ips = [(collector, self.next_ip()) for collector in collectors]
+        for collector, collector_ip in self.collector_ips:
+            collector.connect(self.switch, collector_ip, _SUBNET_NETMASK)
+
+    def next_ip(self):
+        """
+        Assign the next host IP address in ``network``.
+
+        Returns:
+            netaddr.IPAddress: The next unassigned host IP address.
+
+        Raises:
+            RuntimeError: If all of the host IP addresses in ``network``
+                have been assigned.
+        """
+        self._next_host += 1
+        # The last address in the network is the broadcast address
+        if self._next_host >= self.network + _SUBNET_SIZE - 1:
+            raise RuntimeError(
+                f"Ran out of IP addresses in the collector network: {IPAddress(self.network)}"
+            )
+        return IPAddress(self._next_host)
 
 
 class _EdgeTapper:
@@ -58,90 +301,74 @@ class _EdgeTapper:
     :py:class:`Edge <firewheel.control.experiment_graph.Edge>`.
     """
 
-    _gre_key = 1000
-
-    def __init__(self, edge, network):
+    # Many of these are created, so avoid a ``__dict__`` for each of them
+    __slots__ = (
+        "_bridge_name",
+        "_g",
+        "_gre_counter",
+        "_plugin",
+        "_tunnel_params",
+        "collector_network",
+        "tapped_edge",
+    )
+
+    def __init__(self, plugin, edge, collector_network, gre_counter):
         """Initialize the Object.
 
         Arguments:
+            plugin (InsertTaps): The plugin tapping the edge.
             edge (Edge): The edge to tap.
-            network (netaddr.IPNetwork): The network used by the tap VM and
-                the associated collectors.
+            collector_network (_CollectorNetwork): The network connecting the
+                tap VM to the associated collectors.
+            gre_counter (itertools.count): The counter shared by all tapped
+                edges which provides the GRE tunnel keys.
 
         Attributes:
-            _gre_key (int): The initial GRE tunnel key to use.
+            _plugin (InsertTaps): The plugin tapping the edge.
             _g (ExperimentGraph): The NetworkX graph for the given edge.
             tapped_edge (Edge): The edge to tap.
-            network (netaddr.IPNetwork): The network used by the tap VM and
-                the associated collectors.
-            _ips (iter): An iterator for all the IP addresses in ``network``.
+            collector_network (_CollectorNetwork): The network connecting the
+                tap VM to the associated collectors.
             _bridge_name (str): The default name of the bridge. Initially ``"br0"``.
             _tunnel_params (list): Any additional GRE tunnel parameters that are needed/used.
+            _gre_counter (itertools.count): The counter which provides the
+                GRE tunnel keys.
         """
+        self._plugin = plugin
         self._g = edge.source.g
         self.tapped_edge = edge
-        self.network = network
-        self._ips = network.iter_hosts()
+        self.collector_network = collector_network
         # Add network info for the tap
         self._bridge_name = "br0"
         self._tunnel_params = []
+        self._gre_counter = gre_counter
 
-    def tap_edge(self, collectors):
+    def tap_edge(self):
         """
-        Tap the edge using all of the collectors.
+        Tap the edge using all of the collectors on the collector network.
 
         For each tapped edge, break the current link and drop in the
         passive tap. Then hook up the link through the tap. Each tap
         then mirrors the traffic through a GRE tunnel back to the
-        collector that was specified on the edge.
-
-        Args:
-            collectors (list): A list of `Vertex` objects designated to
-                tap the edge.
+        collectors that were specified on the edge.
         """
-        # Ensure that the collectors argument is a list of `Vertex` objects / VM endpoints
-        if not isinstance(collectors, (list, tuple)):
-            collectors = [collectors]
-        collectors = [self._validate_collector(_) for _ in collectors]
+        # Look up the edge details once and pass them to the helpers
+        dst_ip = self.tapped_edge.dst_ip
+        qos = getattr(self.tapped_edge, "qos", None)
+        collector_network = self.collector_network
         # Determine the original switch and endpoint to be tapped
         orig_switch, endpoint = self._determine_edge_switch_and_endpoint()
         # Create the passive tap (requring an extra switch, since the
         # original link is being broken into two separate links)
         tap = self._create_tap(f"tap-{endpoint.name}")
         tap_switch = self._create_switch(f"{tap.name}.switch")
-        tap_collector_switch = self._create_switch(f"{tap.name}-collectors.switch")
         # Reconstruct the physical connections to go through the tap
-        self._reconstruct_edge(endpoint, orig_switch, tap, tap_switch)
-        # Assign IP addresses and mirror traffic to the collectors
-        tap_ip = next(self._ips)
-        collector_ips = {collector: next(self._ips) for collector in collectors}
-        self._mirror_traffic(tap, tap_ip, tap_collector_switch, collector_ips)
-
-    def _validate_collector(self, collector):
-        """
-        Ensure that a given collector is a VM endpoint (or look it up).
-
-        Args:
-            collector (Vertex): A collector to be validated (or, if the
-                collector is provided as a name, find the corresponding
-                :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>`.
-
-        Returns:
-            Vertex: The validated collector vertex.
-
-        Raises:
-            RuntimeError: If the collector specified is not a name of the
-                collector :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` nor the
-                actual :py:class:`Vertex <firewheel.control.experiment_graph.Vertex>` object.
-        """
-        if isinstance(collector, str):
-            collector = self._g.find_vertex(collector)
-        if not collector.is_decorated_by(VMEndpoint):
-            raise RuntimeError(
-                "The collector specified on an `Edge` must be either the "
-                "name of the collector vertex or the `Vertex` object."
-            )
-        return collector
+        self._reconstruct_edge(endpoint, orig_switch, tap, tap_switch, dst_ip, qos)
+        # Assign an IP address and mirror traffic to the collectors
+        tap_ip = collector_network.next_ip()
+        self._mirror_traffic(tap, tap_ip, collector_network, self._bridge_name)
+        # Bridge and mirror the traffic with a single VM resource on the tap
+        tap.emit_boot_script()
 
     def _determine_edge_switch_and_endpoint(self):
         """
@@ -191,7 +418,7 @@ class _EdgeTapper:
         switch.decorate(Switch)
         return switch
 
-    def _reconstruct_edge(self, endpoint, orig_switch, tap, tap_switch):
+    def _reconstruct_edge(self, endpoint, orig_switch, tap, tap_switch, dst_ip, qos):
         """
         Reconstruct the original edge.
 
@@ -207,18 +434,39 @@ class _EdgeTapper:
                 edge segments.
             tap_switch (Vertex): The new switch to add into the reconstructed
                 edge segments.
+            dst_ip (netaddr.IPAddress): The IP address of the endpoint on
+                the edge to be reconstructed.
+            qos (dict): Any QoS details of the edge to be reconstructed.
         """
-        _, tap_to_orig_switch_edge = tap.l2_connect(orig_switch)
-        _, tap_to_tap_switch_edge = tap.l2_connect(tap_switch)
-        new_edge = self._refresh_endpoint_interface(endpoint, tap_switch)
+        self._add_false_edge(tap, orig_switch)
+        self._add_false_edge(tap, tap_switch)
+        new_edge = self._refresh_endpoint_interface(endpoint, tap_switch, dst_ip)
         # Copy over any qos details
-        new_edge.qos = getattr(self.tapped_edge, "qos", None)
-        # Make the new edges "False"
-        tap_to_orig_switch_edge.decorate(FalseEdge)
-        tap_to_tap_switch_edge.decorate(FalseEdge)
-        new_edge.decorate(FalseEdge)
+        new_edge.qos = qos
 
-    def _refresh_endpoint_interface(self, endpoint, tap_switch):
+    def _add_false_edge(self, vertex, switch, address=None, netmask=None):
+        """
+        Connect a vertex to a switch and make the new edge "False".
+
+        Args:
+            vertex (Vertex): The vertex to connect to the switch.
+            switch (Vertex): The switch to connect the vertex to.
+            address (netaddr.IPAddress): The IP address of the new interface.
+                If this is not provided, a layer 2 connection is made.
+            netmask (netaddr.IPAddress): The netmask of the new interface.
+
+        Returns:
+            tuple(str, Edge): The name of the new interface on the vertex and
+            the new :py:class:`base_objects.FalseEdge`.
+        """
+        if address is None:
+            interface_name, edge = vertex.l2_connect(switch)
+        else:
+            interface_name, edge = vertex.connect(switch, address, netmask)
+        edge.decorate(FalseEdge)
+        return interface_name, edge
+
+    def _refresh_endpoint_interface(self, endpoint, tap_switch, dst_ip):
         """
         Refresh the endpoint interface.
 
@@ -227,38 +475,35 @@ class _EdgeTapper:
                 refreshed.
             tap_switch (Vertex): The new tap switch now connected to the
                 VM endpoint.
+            dst_ip (netaddr.IPAddress): The IP address of the interface to
+                be refreshed.
 
         Returns:
-            Edge: The new edge created by connecting the endpoint to the tap
-            switch.
+            Edge: The new :py:class:`base_objects.FalseEdge` created by
+            connecting the endpoint to the tap switch.
 
         Raises:
             RuntimeError: If an interface cannot be found for tapping the
                 endpoint.
         """
-        interface = None
-        for endpoint_interface in endpoint.interfaces.interfaces:
-            if endpoint_interface.get("address") == self.tapped_edge.dst_ip:
-                interface = endpoint_interface
-                break
-        else:
+        interface = self._plugin._find_interface(endpoint, dst_ip)
+        if interface is None:
             raise RuntimeError(
                 f"Could not find interface for tapping on endpoint: {endpoint.name}"
             )
         # Find the original interface, delete it, re-add with info here
         endpoint.interfaces.del_interface(interface["name"])
-        new_interface_name, new_edge = endpoint.connect(
-            tap_switch,
-            interface["address"],
-            interface["netmask"],
+        new_interface_name, new_edge = self._add_false_edge(
+            endpoint, tap_switch, interface["address"], interface["netmask"]
         )
         # Keep the original interface name. This keeps other dictionaries
         # in the vertex that depend on interface names consistent
         new_interface = endpoint.interfaces.get_interface(new_interface_name)
         new_interface["name"] = interface["name"]
+        self._plugin._replace_interface(endpoint, interface["address"], new_interface)
         return new_edge
 
-    def _mirror_traffic(self, tap, tap_ip, tap_collector_switch, collector_ips):
+    def _mirror_traffic(self, tap, tap_ip, collector_network, bridge_name):
         """
         Mirror traffic along the original tapped edge to the collectors.
 
@@ -272,21 +517,18 @@ class _EdgeTapper:
             tap (Vertex): The tap VM from which traffic is mirrored.
             tap_ip (netaddr.IPAddress): The IP address of the tap VM on
                 the collector subnet.
-            tap_collector_switch (Vertex): The switch connecting the tap
-                VM to the collectors.
-            collector_ips (dict): A dictionary mapping collector vertices
-                to their IP address in the subnet defined for this tap.
+            collector_network (_CollectorNetwork): The network connecting the
+                tap VM to the collectors.
+            bridge_name (str): The name of the bridge on the tap VM.
 
         """
-        tap.l2_mitm(self._bridge_name)
-        tap.connect(tap_collector_switch, tap_ip, self.network.netmask)
-        # Connect each collector into the specified tap subnet
+        tap.l2_mitm(bridge_name)
+        tap.connect(collector_network.switch, tap_ip, _SUBNET_NETMASK)
         self._tunnel_params = []
-        for collector, collector_ip in collector_ips.items():
-            collector.connect(tap_collector_switch, collector_ip, self.network.netmask)
+        for collector, collector_ip in collector_network.collector_ips:
             # Set up the GRE tunnel endpoint on the collector
             self._set_up_gre_tunnel_endpoint(collector, collector_ip, tap_ip)
-        tap.mirror_traffic(self._bridge_name, *self._tunnel_params)
+        tap.mirror_traffic(bridge_name, *self._tunnel_params)
 
     def _set_up_gre_tunnel_endpoint(self, collector, collector_ip, tap_ip):
         """
@@ -299,14 +541,7 @@ class _EdgeTapper:
             tap_ip (netaddr.IPAddress): The IP of the tapping VM in the
                 subnet defined for this tap.
         """
-        collector.run_executable(
-            -100,
-            "ip",
-            f"link add tap{self._gre_key} type gretap key {self._gre_key} "
-            f"local {collector_ip} remote {tap_ip} ttl 255",
-        )
-        collector.run_executable(-99, "ip", f"link set dev tap{self._gre_key} up")
-        collector.run_executable(-98, "ip", f"link set tap{self._gre_key} promisc on")
-        self._tunnel_params.append((collector_ip, self._gre_key))
-        # Increment the GRE tunnel key
-        self._gre_key += 1
+        gre_key = next(self._gre_counter)
+        # Defer the tunnel setup so that each collector only runs one VM resource
+        self._plugin._add_gre_endpoint(collector, gre_key, collector_ip, tap_ip)
+        self._tunnel_params.append((collector_ip, gre_key))
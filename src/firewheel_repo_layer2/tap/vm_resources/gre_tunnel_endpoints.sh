@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Each GRE tunnel endpoint is passed in as three args: KEY LOCAL_IP REMOTE_IP
+while [[ $# -ge 3 ]];
+do
+    KEY=$1
+    LOCAL_IP=$2
+    REMOTE_IP=$3
+
+    ip link add tap$KEY type gretap key $KEY local $LOCAL_IP remote $REMOTE_IP ttl 255
+    ip link set dev tap$KEY up
+    ip link set tap$KEY promisc on
+
+    shift 3
+done